@@ -1,17 +1,27 @@
 import os
-import json
+import hashlib
+import tempfile
 import datetime
+import math
+import time
 import logging
-from urllib.parse import urlencode
-from flask import Flask, request, redirect, jsonify
+import threading
+from urllib.parse import urlencode, quote
+from flask import Flask, request, redirect
 from flask_cors import CORS
 from dotenv import load_dotenv
-import requests
+import orjson
+import httpx
+from cachetools import TTLCache
+from cachetools.keys import hashkey
 
 # SQLAlchemy
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import NullPool
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.sql import func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from models import Base, Token
 
 # Load env (for local dev)
@@ -27,26 +37,106 @@ RECEIPTS_API_KEY = os.getenv("RECEIPTS_API_KEY", "devkey")
 DATABASE_URL = os.getenv("DATABASE_URL")
 TOKEN_FILE = os.getenv("TOKEN_FILE", "tokens.json")
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+RECEIPTS_CACHE_TTL = int(os.getenv("RECEIPTS_CACHE_TTL", 30))
+
+# Tokens are kept as a single row with a fixed primary key
+TOKEN_ROW_ID = 1
 
 # QuickBooks endpoints
 QB_AUTH = "https://appcenter.intuit.com/connect/oauth2"
 QB_TOKEN = "https://oauth.platform.intuit.com/oauth2/v1/tokens/bearer"
 QB_BASE = "https://quickbooks.api.intuit.com"
+QUERY_URL_TPL = QB_BASE + "/v3/company/{realm}/query"
+RECEIPT_URL_TPL = QB_BASE + "/v3/company/{realm}/salesreceipt/{rid}"
+# The receipts query never changes, so it is URL-encoded once here
+QUERY_PARAM = '?query=' + quote('select * from SalesReceipt order by MetaData.CreateTime desc maxresults 50', safe='')
+
+# Token endpoint headers; Accept: application/json comes from the HTTP client defaults
+FORM_HEADERS = {'Content-Type': 'application/x-www-form-urlencoded'}
 
 # Logging
 logging.basicConfig(level=LOG_LEVEL)
 logger = logging.getLogger("qbo-backend")
+# httpx logs every request at INFO; keep per-call logging at DEBUG like requests/urllib3 did
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# Shared HTTP/2 client so OAuth/API calls reuse pooled connections and concurrent
+# requests multiplex over one TLS connection instead of paying a fresh TCP+TLS
+# handshake each. The transport retries failed connection attempts only, so
+# token POSTs are never replayed once sent; throttled GETs go through qbo_get().
+HTTP = httpx.Client(
+    timeout=20,
+    headers={'Accept': 'application/json'},
+    transport=httpx.HTTPTransport(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=40),
+        retries=3
+    )
+)
+
+# Intuit's per-minute throttle answers 429 (503 when briefly unavailable); GETs are
+# idempotent, so retry them a couple of times with short, capped backoff
+QBO_RETRY_STATUSES = (429, 503)
+QBO_GET_ATTEMPTS = 3
+
+def qbo_get(url, **kwargs):
+    for attempt in range(QBO_GET_ATTEMPTS):
+        r = HTTP.get(url, **kwargs)
+        if r.status_code not in QBO_RETRY_STATUSES or attempt == QBO_GET_ATTEMPTS - 1:
+            return r
+        try:
+            delay = float(r.headers.get('Retry-After', ''))
+            if not math.isfinite(delay):
+                raise ValueError(delay)
+        except ValueError:
+            delay = 0.3 * 2 ** attempt
+        time.sleep(min(max(0.0, delay), 2))
+    return r
+
+# First 512 bytes of an error body, decoded without decoding the whole response
+def body_snippet(r):
+    return r.content[:512].decode(r.encoding or 'utf-8', 'replace')
+
+# Serializes token refresh/persistence; HTTP calls themselves are not locked
+_token_lock = threading.RLock()
+
+# Seconds to remember that no tokens are stored before checking the DB/file again
+TOKEN_MISS_RECHECK = 30
+
+# In-process copy of the current token so warm workers skip the DB round-trip;
+# the DB/file stays the durable store and is only re-read on miss or near expiry
+_token_cache = {'value': None, 'loaded_at': 0}
 
 # DB setup
 engine = None
 Session = None
 if DATABASE_URL:
     try:
-        engine = create_engine(DATABASE_URL, future=True)
-        Session = sessionmaker(bind=engine)
-        # Ensure tables exist (declarative Base metadata)
-        Base.metadata.create_all(engine)
-        logger.info("Connected to database and ensured tables exist.")
+        if os.getenv("DB_NULL_POOL") == "1":
+            # Serverless-style deploys: no connections held between invocations
+            engine = create_engine(DATABASE_URL, future=True, poolclass=NullPool)
+        else:
+            # QueuePool tuned explicitly: pre_ping + recycle drop connections the
+            # managed Postgres host has closed while idle, pool_timeout bounds the
+            # wait during bursts, and LIFO keeps the warm connections in use.
+            engine = create_engine(
+                DATABASE_URL,
+                future=True,
+                pool_size=5,
+                max_overflow=10,
+                pool_recycle=1800,
+                pool_pre_ping=True,
+                pool_timeout=10,
+                pool_use_lifo=True
+            )
+        # Thread-local sessions, cleared per request in teardown_appcontext
+        Session = scoped_session(sessionmaker(bind=engine, expire_on_commit=False, future=True))
+        # Schema is managed by migrate.py; only run DDL on boot when explicitly asked
+        if os.getenv("RUN_DDL") == "1":
+            Base.metadata.create_all(engine)
+            logger.info("Connected to database and ensured tables exist.")
+        else:
+            logger.info("Configured database engine.")
     except Exception as e:
         logger.exception("Failed to connect to database: %s", e)
 else:
@@ -59,121 +149,179 @@ CORS(app, resources={
     r"/*": {
         "origins": [FRONTEND_URL],
         "methods": ["GET", "POST", "OPTIONS"],
-        "allow_headers": ["Content-Type", "x-api-key"],
+        "allow_headers": ["Content-Type", "x-api-key", "If-None-Match"],
+        "expose_headers": ["ETag"],
         "max_age": 86400
     }
 })
 
+# orjson-backed replacement for flask.jsonify
+def ojsonify(obj):
+    return app.response_class(orjson.dumps(obj, option=orjson.OPT_NAIVE_UTC), mimetype='application/json')
+
+@app.teardown_appcontext
+def remove_db_session(exc=None):
+    if Session:
+        Session.remove()
+
 # ---------------- Token storage helpers ----------------
+def token_record(token_resp, realm_id=None):
+    # Same keys as load_tokens_db() returns, plus the raw token response
+    return {
+        "access_token": token_resp.get("access_token"),
+        "refresh_token": token_resp.get("refresh_token"),
+        "token_type": token_resp.get("token_type"),
+        # Absolute expiry as a Unix timestamp so freshness checks need no parsing
+        "expires_at": time.time() + int(token_resp.get("expires_in", 3600)),
+        "realm_id": realm_id,
+        "raw": token_resp
+    }
+
 def save_tokens_db(token_resp, realm_id=None):
     if not Session:
         return False
-    s = Session()
     try:
-        # Delete previous tokens (keep single row)
-        s.query(Token).delete()
-        t = Token(
-            realm_id=realm_id,
-            access_token=token_resp.get("access_token"),
-            refresh_token=token_resp.get("refresh_token"),
-            token_type=token_resp.get("token_type"),
-            expires_at=(datetime.datetime.utcnow() + datetime.timedelta(seconds=int(token_resp.get("expires_in", 3600)))),
-            raw=token_resp
-        )
-        s.add(t)
-        s.commit()
+        with Session() as s:
+            # Upsert the singleton row (id=1) in one statement instead of DELETE + INSERT
+            values = token_record(token_resp, realm_id)
+            values["expires_at"] = datetime.datetime.utcfromtimestamp(values["expires_at"])
+            stmt = pg_insert(Token).values(id=TOKEN_ROW_ID, **values)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[Token.id],
+                set_={**{k: stmt.excluded[k] for k in values}, "created_at": func.now()}
+            )
+            s.execute(stmt)
+            s.commit()
         logger.info("Saved tokens to database for realm %s", realm_id)
         return True
-    except Exception:
-        logger.exception("Failed to save tokens to DB")
+    except Exception as e:
+        logger.error("Failed to save tokens to DB: %s", e)
         return False
-    finally:
-        s.close()
 
+# Returns None when no token row exists and False when the DB read itself failed
 def load_tokens_db():
     if not Session:
         return None
-    s = Session()
     try:
-        obj = s.query(Token).order_by(Token.id.desc()).first()
-        if not obj:
-            return None
-        return {
-            "access_token": obj.access_token,
-            "refresh_token": obj.refresh_token,
-            "token_type": obj.token_type,
-            "expires_at": obj.expires_at,
-            "realm_id": obj.realm_id,
-            "raw": obj.raw
-        }
-    except Exception:
-        logger.exception("Failed to load tokens from DB")
-        return None
-    finally:
-        s.close()
+        with Session() as s:
+            # Only the typed columns of the singleton row (PK lookup, no sort);
+            # the raw JSON blob is not needed on the request path
+            row = s.query(
+                Token.access_token, Token.refresh_token, Token.token_type,
+                Token.expires_at, Token.realm_id
+            ).filter(Token.id == TOKEN_ROW_ID).first()
+            if not row:
+                return None
+            t = dict(row._mapping)
+            # Stored as naive UTC; convert once here rather than on every freshness check
+            expires_at = t["expires_at"]
+            t["expires_at"] = expires_at.replace(tzinfo=datetime.timezone.utc).timestamp() if expires_at else 0
+            return t
+    except Exception as e:
+        logger.error("Failed to load tokens from DB: %s", e)
+        return False
 
 def save_tokens_file(token_resp, realm_id=None):
     payload = token_resp.copy()
     payload['_realm_id'] = realm_id
+    payload['expires_at'] = token_record(token_resp, realm_id)['expires_at']
+    tmp = None
     try:
-        with open(TOKEN_FILE, 'w') as f:
-            json.dump(payload, f, default=str)
+        # Write to a unique temp file (workers are separate processes) and swap it
+        # in so readers never see a partial or interleaved file
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(TOKEN_FILE) or '.', suffix='.tmp')
+        with os.fdopen(fd, 'wb', buffering=1 << 16) as f:
+            f.write(orjson.dumps(payload, default=str))
+        os.replace(tmp, TOKEN_FILE)
         logger.info("Saved tokens to file fallback %s", TOKEN_FILE)
         return True
     except Exception:
         logger.exception("Failed to write tokens file")
+        if tmp:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
         return False
 
 def load_tokens_file():
     try:
-        with open(TOKEN_FILE, 'r') as f:
-            return json.load(f)
+        with open(TOKEN_FILE, 'rb') as f:
+            return orjson.loads(f.read())
     except Exception:
         return None
 
+def cache_tokens(t):
+    with _token_lock:
+        _token_cache['value'] = t
+        _token_cache['loaded_at'] = time.time()
+
+def invalidate_token_cache():
+    # Also clears the "no tokens" marker so the next lookup goes to the store
+    with _token_lock:
+        _token_cache['value'] = None
+        _token_cache['loaded_at'] = 0
+
+def token_is_fresh(t):
+    return (t.get('expires_at') or 0) > time.time() + 60
+
 def get_tokens():
+    cached = _token_cache['value']
+    if cached and token_is_fresh(cached):
+        return cached
+    # Store was empty on the last lookup: fail fast instead of querying again.
+    # Re-checked periodically so tokens saved by another worker's OAuth callback are picked up.
+    if cached is None and time.time() - _token_cache['loaded_at'] < TOKEN_MISS_RECHECK:
+        return None
     # prefer DB
     t = None
     if Session:
         t = load_tokens_db()
+    db_failed = t is False
     if not t:
         t = load_tokens_file()
+    if not t and db_failed:
+        # Store unreachable, not empty: keep the cached token (its refresh_token may
+        # still work) and don't record a miss
+        return cached
+    cache_tokens(t)
     return t
 
-# Refresh tokens if expired or near expiry
-def refresh_tokens_if_needed():
+# Refresh tokens if expired or near expiry (or unconditionally when forced, e.g. after a 401)
+def refresh_tokens_if_needed(force=False):
     t = get_tokens()
     if not t:
         logger.debug("No tokens available to refresh.")
         return None
-    expires_at = t.get('expires_at')
-    if isinstance(expires_at, str):
-        try:
-            expires_at = datetime.datetime.fromisoformat(expires_at)
-        except Exception:
-            expires_at = None
-    if expires_at and expires_at > datetime.datetime.utcnow() + datetime.timedelta(seconds=60):
+    if not force and token_is_fresh(t):
         return t
     refresh_token = t.get('refresh_token') or (t.get('raw') or {}).get('refresh_token')
     if not refresh_token:
         logger.warning("No refresh token available.")
         return None
+    if not QBO_CLIENT_ID or not QBO_CLIENT_SECRET:
+        logger.error("Missing QBO_CLIENT_ID or QBO_CLIENT_SECRET - cannot refresh tokens.")
+        return None
     auth = (QBO_CLIENT_ID, QBO_CLIENT_SECRET)
-    headers = {'Accept':'application/json', 'Content-Type':'application/x-www-form-urlencoded'}
     data = {'grant_type':'refresh_token', 'refresh_token': refresh_token}
     try:
-        res = requests.post(QB_TOKEN, data=urlencode(data), headers=headers, auth=auth, timeout=15)
+        res = HTTP.post(QB_TOKEN, data=data, headers=FORM_HEADERS, auth=auth, timeout=15)
         if res.status_code != 200:
-            logger.error('Failed to refresh token: %s %s', res.status_code, res.text)
+            # Only materialize (a capped slice of) the response body if it will be logged
+            if logger.isEnabledFor(logging.ERROR):
+                logger.error('Failed to refresh token: %s %s', res.status_code, body_snippet(res))
             return None
-        token_resp = res.json()
+        token_resp = orjson.loads(res.content)
         realm = t.get('realm_id') or (t.get('raw') or {}).get('realmId') or QBO_REALM_ID
-        if Session:
-            save_tokens_db(token_resp, realm)
-        else:
-            save_tokens_file(token_resp, realm)
+        with _token_lock:
+            if Session:
+                save_tokens_db(token_resp, realm)
+            else:
+                save_tokens_file(token_resp, realm)
+            t = token_record(token_resp, realm)
+            cache_tokens(t)
         logger.info("Refreshed tokens successfully.")
-        return get_tokens()
+        return t
     except Exception:
         logger.exception("Exception during token refresh")
         return None
@@ -203,121 +351,205 @@ def callback():
     realm = request.args.get('realmId') or QBO_REALM_ID
     if not code:
         return ('Missing code', 400)
+    if not QBO_CLIENT_ID or not QBO_CLIENT_SECRET:
+        return ("Missing QBO_CLIENT_ID or QBO_CLIENT_SECRET", 500)
     auth = (QBO_CLIENT_ID, QBO_CLIENT_SECRET)
-    headers = {'Accept':'application/json', 'Content-Type':'application/x-www-form-urlencoded'}
     data = {'grant_type':'authorization_code','code':code,'redirect_uri':QBO_REDIRECT_URI}
     try:
-        res = requests.post(QB_TOKEN, data=urlencode(data), headers=headers, auth=auth, timeout=15)
+        res = HTTP.post(QB_TOKEN, data=data, headers=FORM_HEADERS, auth=auth, timeout=15)
         if res.status_code != 200:
-            logger.error('Token exchange failed: %s %s', res.status_code, res.text)
+            if logger.isEnabledFor(logging.ERROR):
+                logger.error('Token exchange failed: %s %s', res.status_code, body_snippet(res))
             return (f'Token exchange failed: {res.status_code}', 500)
-        token_resp = res.json()
-        if Session:
-            save_tokens_db(token_resp, realm)
-        else:
-            save_tokens_file(token_resp, realm)
+        token_resp = orjson.loads(res.content)
+        with _token_lock:
+            if Session:
+                save_tokens_db(token_resp, realm)
+            else:
+                save_tokens_file(token_resp, realm)
+            cache_tokens(token_record(token_resp, realm))
         logger.info("OAuth callback completed for realm %s", realm)
         return redirect(FRONTEND_URL + '/?connected=true')
     except Exception:
         logger.exception("Exception during token exchange")
         return ("Token exchange exception", 500)
 
+# Posted receipts are effectively immutable, so single-receipt lookups are cached
+# per (realm, id) for a few minutes. Clear this from any future write endpoint.
+_receipt_cache = TTLCache(maxsize=1024, ttl=300)
+_rc_lock = threading.Lock()
+
+# Serialized /receipts body, shared by all callers within the TTL window
+_receipts_cache = {'realm': None, 'body': None, 'etag': None, 'exp': 0}
+_receipts_lock = threading.Lock()
+_receipts_fetch_locks = {}
+# Failed upstream fetches per realm: (payload, status, exp). Kept briefly so callers
+# queued behind a failing fetch get its result instead of each retrying QBO in turn
+_receipts_errors = {}
+RECEIPTS_ERROR_TTL = 5
+
+def cached_receipts(realm):
+    now = time.time()
+    with _receipts_lock:
+        if _receipts_cache['realm'] == realm and _receipts_cache['exp'] > now:
+            body, etag = _receipts_cache['body'], _receipts_cache['etag']
+        else:
+            err = _receipts_errors.get(realm)
+            if not err or err[2] <= now:
+                return None
+            return ojsonify(err[0]), err[1]
+    return receipts_response(body, etag)
+
+def receipts_error(realm, payload, status):
+    with _receipts_lock:
+        _receipts_errors[realm] = (payload, status, time.time() + RECEIPTS_ERROR_TTL)
+    return ojsonify(payload), status
+
+def receipts_fetch_lock(realm):
+    with _receipts_lock:
+        return _receipts_fetch_locks.setdefault(realm, threading.Lock())
+
+def receipts_response(body, etag):
+    if request.if_none_match.contains(etag):
+        resp = app.response_class(status=304)
+    else:
+        resp = app.response_class(body, mimetype='application/json')
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = f'private, max-age={RECEIPTS_CACHE_TTL}'
+    return resp
+
 # Simple API key check
 def check_api_key(req):
     key = req.headers.get('x-api-key') or req.args.get('api_key')
     return key == RECEIPTS_API_KEY
 
+# Shared read-only default for missing nested refs; never mutate
+_EMPTY = {}
+
 # Normalize SalesReceipt and extract IssuedBy from LocationRef, SalesRepRef or MetaData.CreateBy
 def normalize_sales_receipt(item):
+    g = item.get
+    loc = g('LocationRef') or _EMPTY
     issued_by = ''
-    loc = item.get('LocationRef') or {}
     if isinstance(loc, dict):
         issued_by = loc.get('name') or loc.get('Value') or loc.get('value') or ''
     if not issued_by:
-        sr = (item.get('SalesRepRef') or {}).get('name') or (item.get('SalesRepRef') or {}).get('value')
-        if sr:
-            issued_by = sr
+        sr = g('SalesRepRef') or _EMPTY
+        issued_by = sr.get('name') or sr.get('value') or ''
     if not issued_by:
-        issued_by = (item.get('MetaData') or {}).get('CreateBy') or (item.get('MetaData') or {}).get('CreateById') or ''
-
-    rec = {
-        'id': item.get('Id'),
-        'txn_date': item.get('TxnDate'),
-        'customer': (item.get('CustomerRef') or {}).get('name') or '',
-        'bill_email': (item.get('BillEmail') or {}).get('Address') or '',
-        'total_amt': item.get('TotalAmt'),
+        meta = g('MetaData') or _EMPTY
+        issued_by = meta.get('CreateBy') or meta.get('CreateById') or ''
+
+    return {
+        'id': g('Id'),
+        'txn_date': g('TxnDate'),
+        'customer': (g('CustomerRef') or _EMPTY).get('name') or '',
+        'bill_email': (g('BillEmail') or _EMPTY).get('Address') or '',
+        'total_amt': g('TotalAmt'),
         'meta': {'IssuedBy': issued_by},
-        'line_items': []
+        # Output keeps three fields per line
+        'line_items': [
+            {
+                'item_ref': ((line.get('SalesItemLineDetail') or _EMPTY).get('ItemRef') or _EMPTY).get('name') or '',
+                'description': line.get('Description') or '',
+                'amount': line.get('Amount') or 0
+            }
+            for line in (g('Line') or ())
+        ]
     }
-    for line in item.get('Line', []):
-        li = {
-            'item_ref': (line.get('SalesItemLineDetail') or {}).get('ItemRef', {}).get('name') or '',
-            'description': line.get('Description') or '',
-            'amount': line.get('Amount') or 0
-        }
-        rec['line_items'].append(li)
-    return rec
+
+# Parse a whole QBO query response with orjson (faster than incremental parsing
+# at <= 50 receipts) and return its SalesReceipt array
+def parse_sales_receipts(content):
+    return (orjson.loads(content).get('QueryResponse') or {}).get('SalesReceipt') or ()
 
 @app.route('/receipts')
 def receipts():
     if not check_api_key(request):
-        return jsonify({'error':'unauthorized'}), 401
+        return ojsonify({'error':'unauthorized'}), 401
     t = refresh_tokens_if_needed()
     if not t:
-        return jsonify({'error':'no_tokens'}), 400
+        return ojsonify({'error':'no_tokens'}), 400
     access_token = t.get('access_token') or (t.get('raw') or {}).get('access_token')
     realm = t.get('realm_id') or (t.get('raw') or {}).get('realmId') or QBO_REALM_ID
     if not access_token or not realm:
-        return jsonify({'error':'missing_credentials'}), 400
+        return ojsonify({'error':'missing_credentials'}), 400
 
-    # Query SalesReceipt
-    url = f'https://quickbooks.api.intuit.com/v3/company/{realm}/query'
-    query_text = 'select * from SalesReceipt order by MetaData.CreateTime desc maxresults 50'
-    headers = {'Authorization': f'Bearer {access_token}', 'Accept':'application/json'}
-    try:
-        r = requests.get(url, params={'query': query_text}, headers=headers, timeout=20)
-        if r.status_code == 401:
-            refresh_tokens_if_needed()
-            t = get_tokens()
-            access_token = t.get('access_token') or (t.get('raw') or {}).get('access_token')
-            headers['Authorization'] = f'Bearer {access_token}'
-            r = requests.get(url, params={'query': query_text}, headers=headers, timeout=20)
-        if r.status_code != 200:
-            logger.error('QBO query failed: %s %s', r.status_code, r.text)
-            return jsonify({'error':'qbo_query_failed','status':r.status_code,'text':r.text}), 500
-        data = r.json()
-        items = data.get('QueryResponse', {}).get('SalesReceipt', [])
-        receipts = [normalize_sales_receipt(it) for it in items]
-        receipts = sorted(receipts, key=lambda r: r.get('txn_date') or '', reverse=True)[:50]
-        return jsonify({'receipts': receipts})
-    except Exception:
-        logger.exception("Exception querying QBO")
-        return jsonify({'error':'exception'}), 500
+    cached = cached_receipts(realm)
+    if cached:
+        return cached
+
+    # Single-flight: one thread per realm queries QBO when the cache expires,
+    # the rest wait here and are served the body or error it stores
+    with receipts_fetch_lock(realm):
+        cached = cached_receipts(realm)
+        if cached:
+            return cached
+
+        # Query SalesReceipt
+        url = QUERY_URL_TPL.format(realm=realm) + QUERY_PARAM
+        headers = {'Authorization': f'Bearer {access_token}'}
+        try:
+            r = qbo_get(url, headers=headers, timeout=20)
+            if r.status_code == 401:
+                invalidate_token_cache()
+                t = refresh_tokens_if_needed(force=True)
+                if not t:
+                    return ojsonify({'error':'no_tokens'}), 400
+                access_token = t.get('access_token') or (t.get('raw') or {}).get('access_token')
+                headers['Authorization'] = f'Bearer {access_token}'
+                r = qbo_get(url, headers=headers, timeout=20)
+            if r.status_code != 200:
+                text = body_snippet(r)
+                logger.error('QBO query failed: %s %s', r.status_code, text)
+                return receipts_error(realm, {'error':'qbo_query_failed','status':r.status_code,'text':text}, 500)
+            receipts = [normalize_sales_receipt(it) for it in parse_sales_receipts(r.content)]
+            body = orjson.dumps({'receipts': receipts}, option=orjson.OPT_NAIVE_UTC)
+            etag = hashlib.blake2b(body, digest_size=8).hexdigest()
+            with _receipts_lock:
+                _receipts_cache.update(realm=realm, body=body, etag=etag, exp=time.time() + RECEIPTS_CACHE_TTL)
+                _receipts_errors.pop(realm, None)
+            return receipts_response(body, etag)
+        except Exception:
+            logger.exception("Exception querying QBO")
+            return receipts_error(realm, {'error':'exception'}, 500)
 
 # Optional single receipt endpoint
 @app.route('/receipt/<rid>')
 def get_receipt(rid):
     if not check_api_key(request):
-        return jsonify({'error':'unauthorized'}), 401
+        return ojsonify({'error':'unauthorized'}), 401
     t = refresh_tokens_if_needed()
     if not t:
-        return jsonify({'error':'no_tokens'}), 400
+        return ojsonify({'error':'no_tokens'}), 400
     access_token = t.get('access_token') or (t.get('raw') or {}).get('access_token')
     realm = t.get('realm_id') or (t.get('raw') or {}).get('realmId') or QBO_REALM_ID
-    url = f'https://quickbooks.api.intuit.com/v3/company/{realm}/salesreceipt/{rid}'
-    headers = {'Authorization': f'Bearer {access_token}', 'Accept':'application/json'}
+    key = hashkey(realm, rid)
+    with _rc_lock:
+        cached = _receipt_cache.get(key)
+    if cached is not None:
+        return ojsonify({'receipt': cached})
+    url = RECEIPT_URL_TPL.format(realm=realm, rid=rid)
+    headers = {'Authorization': f'Bearer {access_token}'}
     try:
-        r = requests.get(url, headers=headers, timeout=15)
+        r = qbo_get(url, headers=headers, timeout=15)
         if r.status_code != 200:
-            return jsonify({'error':'qbo_query_failed','status':r.status_code}), 500
-        item = r.json().get('SalesReceipt')
+            return ojsonify({'error':'qbo_query_failed','status':r.status_code}), 500
+        item = orjson.loads(r.content).get('SalesReceipt')
         if not item:
-            return jsonify({'error':'not_found'}), 404
-        return jsonify({'receipt': normalize_sales_receipt(item)})
+            return ojsonify({'error':'not_found'}), 404
+        rec = normalize_sales_receipt(item)
+        with _rc_lock:
+            _receipt_cache[key] = rec
+        return ojsonify({'receipt': rec})
     except Exception:
         logger.exception("Exception fetching single receipt")
-        return jsonify({'error':'exception'}), 500
+        return ojsonify({'error':'exception'}), 500
 
 if __name__ == '__main__':
-    # Local debug server
-    app.run(host='0.0.0.0', port=int(os.getenv('PORT', 5000)), debug=os.getenv('FLASK_DEBUG')=='1')
+    # Local debug server only; production runs under gunicorn (see Procfile)
+    if os.getenv('FLASK_DEBUG') != '1':
+        logger.warning("Refusing to start the Flask dev server without FLASK_DEBUG=1; "
+                       "use: gunicorn -k gthread -w 4 --threads 8 --timeout 30 app_prod:app")
+        raise SystemExit(1)
+    app.run(host='0.0.0.0', port=int(os.getenv('PORT', 5000)), debug=True)
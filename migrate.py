@@ -6,9 +6,9 @@ DATABASE_URL = os.environ.get('DATABASE_URL')
 if not DATABASE_URL:
     raise SystemExit('Set DATABASE_URL before running migrate.py')
 engine = create_engine(DATABASE_URL)
-with engine.connect() as conn:
-    with open('migrate.sql','r') as f:
-        sql = f.read()
+with open('migrate.sql','r') as f:
+    sql = f.read()
+# Single transaction: committed on success, rolled back on error
+with engine.begin() as conn:
     conn.execute(text(sql))
-    conn.commit()
-    print('Migration complete.')
+print('Migration complete.')
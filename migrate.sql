@@ -8,3 +8,12 @@ CREATE TABLE IF NOT EXISTS tokens (
   raw jsonb,
   created_at timestamp default now()
 );
+
+-- Tables created by SQLAlchemy's create_all used json; store raw as jsonb
+ALTER TABLE tokens ALTER COLUMN raw TYPE jsonb USING raw::jsonb;
+
+-- Tokens are upserted into a single row with id = 1: keep only the latest row and pin it there
+DELETE FROM tokens WHERE id <> (SELECT max(id) FROM tokens);
+UPDATE tokens SET id = 1 WHERE id <> 1;
+ALTER TABLE tokens DROP CONSTRAINT IF EXISTS tokens_singleton;
+ALTER TABLE tokens ADD CONSTRAINT tokens_singleton CHECK (id = 1);
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, DateTime, Text, JSON
+from sqlalchemy import Column, Integer, String, DateTime, Text, CheckConstraint
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.sql import func
 
@@ -6,11 +7,13 @@ Base = declarative_base()
 
 class Token(Base):
     __tablename__ = 'tokens'
+    # Single-row table: tokens are always upserted at id = 1
+    __table_args__ = (CheckConstraint('id = 1', name='tokens_singleton'),)
     id = Column(Integer, primary_key=True)
     realm_id = Column(String(128))
     access_token = Column(Text, nullable=False)
     refresh_token = Column(Text, nullable=False)
     token_type = Column(String(32))
     expires_at = Column(DateTime)
-    raw = Column(JSON)
+    raw = Column(JSONB)
     created_at = Column(DateTime, server_default=func.now())